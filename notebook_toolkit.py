@@ -1,16 +1,67 @@
+import hashlib
+import io
+import json
+import re
+import shutil
 import sys
 import time
 import nbformat
-from jupyter_client import KernelManager
-from queue import Empty
+from queue import Empty, Queue
 import os
-import atexit
+import contextlib
 from datetime import datetime
 
+# orjson is optional: a much faster parser for large, output-heavy notebooks
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 VERSION = "1.0.0"
 AUTHOR = 'SW Engineer Garzola Marco'
 
-def run_notebook_realtime_extended(notebook_path, cell_timeout=3600, output_file=None, cell_range=None):
+SEP = '=' * 60
+SHOW_SEP = '-' * 40
+PREVIEW_CHARS = 300
+
+# Output file buffering: write in large blocks, flush at cell boundaries and
+# errors, and otherwise at most every FLUSH_INTERVAL seconds
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+FLUSH_INTERVAL = 0.25
+_last_flush = [0.0]
+
+# Kernel stream output is coalesced and written when STREAM_FLUSH_INTERVAL
+# has elapsed, STREAM_BUFFER_SIZE is reached or any other output is logged
+STREAM_BUFFER_SIZE = 65536
+STREAM_FLUSH_INTERVAL = 0.1
+_stream_buf = io.StringIO()
+_last_stream_flush = [0.0]
+
+# ANSI escape sequences (colors in kernel tracebacks) and the bytes dropped
+# from traceback lines (DEL and everything outside ASCII)
+_ANSI_RE = re.compile(r'\x1b\[[0-9;?]*[A-Za-z]')
+_NON_ASCII_BYTES = bytes(range(127, 256))
+
+# Execution cache: outputs of successful cells, stored next to the notebook
+# in CACHE_DIR/<notebook name>/<chained source hash>.json
+CACHE_DIR = '.cache'
+CACHED_MSG_TYPES = ('stream', 'execute_result', 'display_data', 'error')
+CACHE_OFF_MSG = "⚠️ Execution cache disabled for the rest of this run"
+
+# First line marking a cell as independent of the others (run --parallel N)
+PARALLEL_MAGIC = '%%parallel'
+
+# Failure policies for run/batch --on-error
+ON_ERROR_CHOICES = ('ask', 'continue', 'stop')
+
+# Connection file shared between the daemon command and run --kernel
+DAEMON_CONNECTION_FILE = os.path.join(os.path.expanduser('~'), '.jupyter-in-a-shell', 'kernel.json')
+
+# Last formatted HH:MM:SS timestamp, keyed by integer epoch second
+_ts_cache = [0, '']
+
+def run_notebook_realtime_extended(notebook_path, cell_timeout=3600, output_file=None, cell_range=None, debug=False,
+                                   use_cache=False, kernel=None, sources=None, parallel=0, on_error='ask'):
     """
     Executes a Jupyter notebook sequentially and robustly.
     Args:
@@ -18,117 +69,275 @@ def run_notebook_realtime_extended(notebook_path, cell_timeout=3600, output_file
         cell_timeout: Timeout per cell (0 = no timeout)
         output_file: File to save output (None = console only)
         cell_range: tuple (start, end) 1-based inclusive, or None for all
+        debug: Also log kernel busy/idle status transitions
+        use_cache: Replay cells whose source (and all previous sources) are unchanged
+                   since the last successful run instead of executing them
+        kernel: (km, kc) pair from start_kernel() or connect_kernel() to reuse; its namespace is reset
+                before running and it is left running afterwards
+        sources: Stripped sources of the non-empty code cells from code_cell_sources()
+                 (None = read them from notebook_path)
+        parallel: Number of worker kernels for consecutive %%parallel cells (0 or 1 = run them sequentially)
+        on_error: What to do when a cell fails: 'ask' (prompt), 'continue' or 'stop'
+    Returns (completed, failed_cells): completed is False if execution was stopped
+    or interrupted before the last cell, failed_cells lists the numbers of the
+    cells that failed or timed out.
     """
-    # Setup output file if specified
+    # Setup output file if specified: stray stdout/stderr writes are
+    # redirected into it only for the duration of this call
     output_stream = None
-    if output_file:
-        output_stream = open(output_file, 'w', encoding='utf-8', buffering=1)
-        log(f"📝 Output will be saved to: {output_file}", output_stream)
+    with contextlib.ExitStack() as stack:
+        if output_file:
+            output_stream = stack.enter_context(
+                open(output_file, 'w', encoding='utf-8', buffering=OUTPUT_BUFFER_SIZE))
+            stack.enter_context(contextlib.redirect_stdout(output_stream))
+            stack.enter_context(contextlib.redirect_stderr(output_stream))
+            log(f"📝 Output will be saved to: {output_file}", output_stream)
+
+        if sources is None:
+            sources = code_cell_sources(load_notebook(notebook_path))
+        if cell_range:
+            start, end = cell_range
+            sources = sources[start-1:end]
+        # Per-cell invariants: (source, header preview, marked %%parallel)
+        code_cells = [(code, code if len(code) <= PREVIEW_CHARS else code[:PREVIEW_CHARS] + '...', is_parallel)
+                      for code, is_parallel in map(split_parallel_magic, sources)]
+
+        owns_kernel = kernel is None
+        if owns_kernel:
+            km, kc = start_kernel(output_stream)
+        else:
+            km, kc = kernel
+            reset_kernel(kc, output_stream)
+
+        completed = True
+        failed_cells = []
+        total = len(code_cells)
+        first_cell = cell_range[0] if cell_range else 1
+        cache_dir = get_cache_dir(notebook_path)
+        chain = ''
+        # Cells replayed from the cache but not yet executed in the kernel
+        pending = []
+        workers = None
+
+        try:
+            if parallel > 1 and any(is_parallel for _, _, is_parallel in code_cells):
+                workers = start_workers(parallel, output_stream)
+
+            i = 0
+            while i < total:
+                code, preview, is_parallel = code_cells[i]
+                cell_num = first_cell + i
+
+                if workers is not None and is_parallel:
+                    # Run the whole group of consecutive %%parallel cells at once
+                    j = i
+                    while j < total and code_cells[j][2]:
+                        j += 1
+                    group = code_cells[i:j]
+                    if use_cache:
+                        for group_code, _, _ in group:
+                            chain = chain_hash(chain, group_code)
+                    results = run_parallel_group(workers, [group_code for group_code, _, _ in group], cell_timeout)
+                    for offset, ((_, group_preview, _), result) in enumerate(zip(group, results)):
+                        log(cell_header(cell_num + offset, total, group_preview, parallel=True), output_stream)
+                        success = log_parallel_result(result, output_stream, debug)
+                        if not success:
+                            failed_cells.append(cell_num + offset)
+                            if use_cache:
+                                log(CACHE_OFF_MSG, output_stream)
+                                use_cache = False
+                        if not report_cell_result(cell_num + offset, success, output_stream, on_error):
+                            completed = False
+                            break
+                    if not completed:
+                        break
+                    i = j
+                    continue
+
+                i += 1
+                log(cell_header(cell_num, total, preview), output_stream)
+
+                outputs = None
+                if use_cache:
+                    chain = chain_hash(chain, code)
+                    cached = load_cached_outputs(cache_dir, chain)
+                    if cached is not None:
+                        log("💾 Unchanged since last run, replaying cached output", output_stream)
+                        for msg in cached:
+                            output_hook(msg, output_stream, debug)
+                        pending.append(code)
+                        log(f"\n✅ Cell {cell_num} completed successfully (cached)", output_stream)
+                        flush_output(output_stream, force=True)
+                        continue
+                    restored = not pending or restore_kernel_state(kc, pending, cell_timeout, output_stream)
+                    pending = []
+                    if restored:
+                        outputs = []
+                    else:
+                        log(CACHE_OFF_MSG, output_stream)
+                        use_cache = False
+
+                # Execute the cell
+                success = execute_cell_simple(kc, code, cell_num, cell_timeout, output_stream, debug, outputs)
+                if not success:
+                    failed_cells.append(cell_num)
+                if outputs is not None:
+                    if success:
+                        store_cached_outputs(cache_dir, chain, outputs)
+                    else:
+                        # The cache key only covers sources: outputs of later cells
+                        # depend on this failure, so neither replay nor store them
+                        log(CACHE_OFF_MSG, output_stream)
+                        use_cache = False
+
+                if not report_cell_result(cell_num, success, output_stream, on_error):
+                    completed = False
+                    break
+            
+        except KeyboardInterrupt:
+            log("\n\n🛑 Execution interrupted by user", output_stream)
+            completed = False
+            try:
+                interrupt_kernel(km, kc)
+                wait_for_idle(kc, timeout=2)
+            except:
+                pass
         
-        devnull = open(os.devnull, 'w')
-        sys.stdout = devnull
-        sys.stderr = devnull
-        # Cleanup: close devnull at the end of execution
-        def cleanup_output():
-            if output_stream and not output_stream.closed:
-                output_stream.close()
-            if devnull and not devnull.closed:
-                devnull.close()
-        atexit.register(cleanup_output)
-
-    with open(notebook_path, "r", encoding="utf-8") as f:
-        nb = nbformat.read(f, as_version=4)
-
-    code_cells = [cell for cell in nb.cells if cell.cell_type == 'code' and cell.source.strip()]
-    if cell_range:
-        start, end = cell_range
-        code_cells = code_cells[start-1:end]
-
-    # Configure the kernel manager
-    km = KernelManager()
+        finally:
+            if workers is not None:
+                stop_workers(workers)
+            if owns_kernel:
+                log("\n📋 Cleaning up...", output_stream)
+                stop_kernel(km, kc)
+                log("✅ Cleanup complete", output_stream)
+
+    return completed, failed_cells
+
+def cell_header(cell_num, total, preview, parallel=False):
+    """Banner logged before each cell"""
+    return (f"\n{SEP}\n"
+            f"📋 Executing cell {cell_num}/{total}{' (parallel)' if parallel else ''}\n"
+            f"{SEP}\n"
+            f"Code preview:\n{preview}\n"
+            f"{SEP}\n")
+
+def report_cell_result(cell_num, success, output_stream=None, on_error='ask'):
+    """
+    Log the outcome of a cell; on failure apply the on_error policy
+    ('ask' prompts the user, 'continue' or 'stop' never block on stdin).
+    Returns False if execution should stop.
+    """
+    if success:
+        log(f"\n✅ Cell {cell_num} completed successfully", output_stream)
+        flush_output(output_stream, force=True)
+        return True
+    log(f"\n❌ Cell {cell_num} failed or timed out", output_stream)
+    flush_output(output_stream, force=True)
+    if on_error == 'continue':
+        log("⏭️ Continuing with next cell (--on-error continue)", output_stream)
+        return True
+    if on_error == 'stop':
+        log("🛑 Execution stopped (--on-error stop)", output_stream)
+        return False
+    try:
+        user_input = input("\nContinue with next cell? (y/n/q): ").strip().lower()
+    except EOFError:
+        user_input = 'q'
+    if user_input != 'y':
+        log("🛑 Execution stopped by user", output_stream)
+        return False
+    return True
+
+def default_on_error():
+    """Prompt only when a user can answer: stop on failures when stdin is not a TTY"""
+    return 'ask' if sys.stdin.isatty() else 'stop'
+
+def start_kernel(output_stream=None, connection_file=None):
+    """
+    Start a kernel and wait until it is ready. Returns the (km, kc) pair.
+    If connection_file is given, the kernel's connection info is written there.
+    """
+    # jupyter_client is only imported when a kernel is actually needed,
+    # keeping show/edit/info startup fast
+    from jupyter_client import KernelManager
+    if connection_file:
+        os.makedirs(os.path.dirname(os.path.abspath(connection_file)), exist_ok=True)
+        km = KernelManager(connection_file=connection_file)
+    else:
+        km = KernelManager()
     km.start_kernel()
     kc = km.client()
     kc.start_channels()
-    
+
     # Wait for the kernel to be ready
     log("🔄 Waiting for kernel to be ready...", output_stream)
     kc.wait_for_ready(timeout=60)
     log("✅ Kernel ready!", output_stream)
-    
+    return km, kc
+
+def connect_kernel(connection_file, output_stream=None):
+    """
+    Connect to an already running kernel (e.g. started by the daemon command).
+    Returns the (None, kc) pair: the kernel is not owned by this process.
+    """
+    from jupyter_client import BlockingKernelClient
+    kc = BlockingKernelClient(connection_file=connection_file)
+    kc.load_connection_file()
+    kc.start_channels()
+
+    log(f"🔌 Connecting to kernel: {connection_file}", output_stream)
+    kc.wait_for_ready(timeout=60)
+    log("✅ Kernel ready!", output_stream)
+    return None, kc
+
+def stop_kernel(km, kc):
+    """
+    Stop the channels and shut down a kernel started with start_kernel().
+    Kernels obtained with connect_kernel() (km is None) are left running.
+    """
     try:
-        for i, cell in enumerate(code_cells):
-            code = cell.source.strip()
-            cell_num = i + 1 if not cell_range else cell_range[0] + i
-
-            log(f"\n{'='*60}", output_stream)
-            log(f"📋 Executing cell {cell_num}/{len(code_cells)}", output_stream)
-            log(f"{'='*60}", output_stream)
-            log(f"Code preview:\n{code[:300]}{'...' if len(code) > 300 else ''}", output_stream)
-            log(f"{'='*60}\n", output_stream)
-            
-            # Execute the cell
-            success = execute_cell_simple(kc, code, cell_num, cell_timeout, output_stream)
-            
-            if not success:
-                log(f"\n❌ Cell {cell_num} failed or timed out", output_stream)
-                user_input = input("\nContinue with next cell? (y/n/q): ").strip().lower()
-                if user_input == 'q':
-                    log("🛑 Execution stopped by user", output_stream)
-                    break
-                elif user_input != 'y':
-                    log("🛑 Execution stopped by user", output_stream)
-                    break
-            else:
-                log(f"\n✅ Cell {cell_num} completed successfully", output_stream)
-            
-    except KeyboardInterrupt:
-        log("\n\n🛑 Execution interrupted by user", output_stream)
-        try:
-            kc.interrupt_kernel()
-            time.sleep(2)
-        except:
-            pass
-        
-    finally:
-        log("\n📋 Cleaning up...", output_stream)
-        try:
-            kc.stop_channels()
+        kc.stop_channels()
+        if km is not None:
             km.shutdown_kernel()
-        except:
-            pass
-            
-        if output_stream:
-            output_stream.close()
-            
-        log("✅ Cleanup complete", output_stream)
+    except:
+        pass
+
+def interrupt_kernel(km, kc):
+    """Interrupt the running cell, via the control channel for connected kernels"""
+    if km is not None:
+        km.interrupt_kernel()
+    else:
+        kc.control_channel.send(kc.session.msg('interrupt_request', content={}))
 
-def execute_cell_simple(kc, code, cell_num, timeout, output_stream=None):
+def reset_kernel(kc, output_stream=None, timeout=60):
+    """Clear the namespace of a reused kernel before running another notebook"""
+    log("♻️ Reusing kernel, resetting its namespace...", output_stream)
+    execute_and_drain(kc, "%reset -f", timeout, lambda msg: None)
+
+def execute_cell_simple(kc, code, cell_num, timeout, output_stream=None, debug=False, outputs=None):
     """
-    Simplified version that only uses execute_interactive
+    Execute a single cell, streaming its output through output_hook.
+    If outputs is a list, the cell's output messages are appended to it.
     """
-    log(f"🚀 Starting execution at {time.strftime('%H:%M:%S')}", output_stream)
+    log(f"🚀 Starting execution at {_hhmmss()}", output_stream)
     start_time = time.time()
     
     # Create output hook that uses our logging system
     def cell_output_hook(msg):
-        output_hook(msg, output_stream)
+        output_hook(msg, output_stream, debug)
+        if outputs is not None and msg['header']['msg_type'] in CACHED_MSG_TYPES:
+            outputs.append({'header': {'msg_type': msg['header']['msg_type']},
+                            'content': msg['content']})
+
+    # While the cell is quiet, write out queued stream text and let the timed
+    # flush push the header and any partial output to the file
+    def cell_on_wait():
+        flush_stream_buffer(output_stream)
+        flush_output(output_stream)
     
     try:
-        # Use execute_interactive - if timeout is 0 or None, do not use timeout
-        if timeout == 0 or timeout is None:
-            reply = kc.execute_interactive(
-                code, 
-                timeout=None,  # No timeout
-                output_hook=cell_output_hook,
-                stdin_hook=None
-            )
-        else:
-            reply = kc.execute_interactive(
-                code, 
-                timeout=timeout,
-                output_hook=cell_output_hook,
-                stdin_hook=None
-            )
+        # If timeout is 0 or None, do not use timeout
+        reply = execute_and_drain(kc, code, timeout or None, cell_output_hook, on_wait=cell_on_wait)
         
         elapsed = time.time() - start_time
         log(f"\n⏱️ Completed in {elapsed:.2f}s", output_stream)
@@ -141,83 +350,490 @@ def execute_cell_simple(kc, code, cell_num, timeout, output_stream=None):
             return True
             
     except Exception as e:
-        elapsed = time.time() - start_time
-        if "timeout" in str(e).lower():
-            log(f"\n⏰ TIMEOUT after {elapsed:.2f}s", output_stream)
-        else:
-            log(f"\n❌ Execution error: {e}", output_stream)
+        log_execution_error(e, time.time() - start_time, output_stream)
         return False
 
-def output_hook(msg, output_stream=None):
+def log_execution_error(error, elapsed, output_stream=None):
+    """Log a timeout or an error raised while waiting for a cell"""
+    if "timeout" in str(error).lower():
+        log(f"\n⏰ TIMEOUT after {elapsed:.2f}s", output_stream)
+    else:
+        log(f"\n❌ Execution error: {error}", output_stream)
+
+def execute_and_drain(kc, code, timeout, hook, on_wait=None):
+    """
+    Send an execute request and read IOPub directly until the kernel is idle.
+    The channel sockets are polled directly (bypassing the client's
+    sync-over-async get_*_msg wrappers) and all ready messages are drained
+    in one go after each wakeup. Needs jupyter_client >= 8, where the channel
+    methods are synchronous (on 7.x they are coroutines).
+    Args:
+        kc: Blocking kernel client
+        code: Source to execute
+        timeout: Overall timeout in seconds (None = no timeout)
+        hook: Called with every IOPub message belonging to this request
+        on_wait: Called every STREAM_FLUSH_INTERVAL seconds while no output arrives
+    Returns the execute_reply message.
+    """
+    msg_id = kc.execute(code, allow_stdin=False)
+    iopub = kc.iopub_channel
+    shell = kc.shell_channel
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    def remaining():
+        if deadline is None:
+            return None
+        left = deadline - time.monotonic()
+        if left <= 0:
+            raise TimeoutError("Timeout waiting for output")
+        return left
+
+    # Output: everything up to the idle status for our request
+    while True:
+        wait = remaining()
+        if on_wait is not None and (wait is None or wait > STREAM_FLUSH_INTERVAL):
+            wait = STREAM_FLUSH_INTERVAL
+        try:
+            msgs = [iopub.get_msg(timeout=wait)]
+        except Empty:
+            if on_wait is None:
+                raise TimeoutError("Timeout waiting for output")
+            on_wait()
+            continue
+        while iopub.msg_ready():
+            msgs.append(iopub.get_msg(timeout=0))
+        if _dispatch_iopub(msgs, msg_id, hook):
+            break
+
+    # Reply: the matching execute_reply on the shell channel
+    while True:
+        try:
+            reply = shell.get_msg(timeout=remaining())
+        except Empty:
+            raise TimeoutError("Timeout waiting for reply")
+        if reply['parent_header'].get('msg_id') == msg_id:
+            return reply
+
+def _dispatch_iopub(msgs, msg_id, hook):
+    """Pass the messages of request msg_id to hook; True once it is idle"""
+    for msg in msgs:
+        if msg['parent_header'].get('msg_id') != msg_id:
+            continue
+        hook(msg)
+        if (msg['header']['msg_type'] == 'status'
+                and msg['content'].get('execution_state') == 'idle'):
+            return True
+    return False
+
+def split_parallel_magic(code):
+    """
+    Return (code, is_parallel), removing a leading %%parallel line: the marker
+    is not a real IPython magic, so it must never reach the kernel
+    """
+    first_line, _, rest = code.partition('\n')
+    if first_line.strip() != PARALLEL_MAGIC:
+        return code, False
+    return rest.strip(), True
+
+def start_workers(count, output_stream=None):
+    """
+    Start count worker kernels for %%parallel cells.
+    Returns (mkm, kernels, pool): pool is a Queue of idle (km, kc) pairs.
+    """
+    from jupyter_client import MultiKernelManager
+    log(f"🔄 Starting {count} worker kernels for %%parallel cells...", output_stream)
+    mkm = MultiKernelManager()
+    kernels = []
+    pool = Queue()
+    try:
+        for _ in range(count):
+            km = mkm.get_kernel(mkm.start_kernel())
+            kc = km.client()
+            kc.start_channels()
+            kernels.append((km, kc))
+        for km, kc in kernels:
+            kc.wait_for_ready(timeout=60)
+            pool.put((km, kc))
+    except BaseException:
+        stop_workers((mkm, kernels, pool))
+        raise
+    log("✅ Worker kernels ready!", output_stream)
+    return mkm, kernels, pool
+
+def stop_workers(workers):
+    """Shut down the worker kernels started by start_workers()"""
+    mkm, kernels, _ = workers
+    for km, kc in kernels:
+        try:
+            kc.stop_channels()
+        except:
+            pass
+    try:
+        mkm.shutdown_all(now=True)
+    except:
+        pass
+
+def run_parallel_group(workers, codes, timeout):
+    """
+    Execute independent cells concurrently on the worker kernels.
+    Returns one (success, outputs, elapsed, error) tuple per cell, in order.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    _, kernels, pool = workers
+    executor = ThreadPoolExecutor(max_workers=len(kernels))
+    try:
+        futures = [executor.submit(_run_on_worker, pool, code, timeout) for code in codes]
+        return [future.result() for future in futures]
+    except KeyboardInterrupt:
+        for km, _ in kernels:
+            try:
+                km.interrupt_kernel()
+            except:
+                pass
+        raise
+    finally:
+        executor.shutdown(wait=False)
+
+def _run_on_worker(pool, code, timeout):
+    """
+    Run one cell on an idle worker kernel, collecting its output messages.
+    The worker namespace is reset first, so the cell never sees variables
+    left by earlier %%parallel cells on the same worker.
+    """
+    km, kc = pool.get()
+    outputs = []
+
+    def collect(msg):
+        if msg['header']['msg_type'] in CACHED_MSG_TYPES:
+            outputs.append(msg)
+
+    start_time = time.time()
+    try:
+        execute_and_drain(kc, "%reset -f", timeout or None, lambda msg: None)
+        reply = execute_and_drain(kc, code, timeout or None, collect)
+        return reply['content']['status'] != 'error', outputs, time.time() - start_time, None
+    except Exception as e:
+        # Free the worker: a timed out cell would otherwise keep it busy
+        try:
+            km.interrupt_kernel()
+            wait_for_idle(kc, timeout=2)
+        except:
+            pass
+        return False, outputs, time.time() - start_time, e
+    finally:
+        pool.put((km, kc))
+
+def log_parallel_result(result, output_stream=None, debug=False):
+    """Log the output collected for a cell run on a worker; returns its success"""
+    success, outputs, elapsed, error = result
+    for msg in outputs:
+        output_hook(msg, output_stream, debug)
+    if error is not None:
+        log_execution_error(error, elapsed, output_stream)
+        return False
+    log(f"\n⏱️ Completed in {elapsed:.2f}s", output_stream)
+    if not success:
+        log("❌ Cell execution failed", output_stream)
+    return success
+
+def restore_kernel_state(kc, codes, timeout, output_stream=None):
+    """
+    Silently execute cells that were replayed from the cache, so that the
+    kernel state matches what the following (uncached) cells expect
+    """
+    log(f"🔁 Re-running {len(codes)} cached cell(s) to restore kernel state...", output_stream)
+    for code in codes:
+        try:
+            reply = execute_and_drain(kc, code, timeout or None, lambda msg: None)
+        except Exception as e:
+            log(f"⚠️ Could not restore kernel state: {e}", output_stream)
+            return False
+        if reply['content']['status'] == 'error':
+            log("⚠️ Could not restore kernel state: a cached cell failed", output_stream)
+            return False
+    return True
+
+def wait_for_idle(kc, timeout=2, poll_interval=0.05):
+    """
+    Drain IOPub until the kernel reports idle or timeout seconds elapse
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            msg = kc.iopub_channel.get_msg(timeout=poll_interval)
+        except Empty:
+            continue
+        if (msg['header']['msg_type'] == 'status'
+                and msg['content'].get('execution_state') == 'idle'):
+            return True
+    return False
+
+def _handle_stream(content, output_stream):
+    # Print, logging output
+    buffer_stream(content.get('text', ''), output_stream)
+
+def _handle_execute_result(content, output_stream):
+    # Expression result
+    data = content.get('data', {})
+    if 'text/plain' in data:
+        log(f"\n📤 Output: {data['text/plain']}", output_stream)
+
+def _handle_display_data(content, output_stream):
+    # Plots, images
+    data = content.get('data', {})
+    if 'text/plain' in data:
+        log(f"\n🖼️ Display: {data['text/plain']}", output_stream)
+
+def _handle_error(content, output_stream):
+    ename = content.get('ename', 'Error')
+    evalue = content.get('evalue', 'Unknown error')
+    traceback = content.get('traceback', [])
+
+    log(f"\n❌ {ename}: {evalue}", output_stream)
+    for line in traceback:
+        # Remove ANSI codes for cleaner output
+        clean_line = clean_traceback_line(line)
+        log(clean_line, output_stream, level='ERROR')
+    flush_output(output_stream, force=True)
+
+def clean_traceback_line(line):
+    """Strip ANSI escape sequences and non-ASCII characters from a line"""
+    has_escape = '\x1b' in line
+    # DEL is ASCII but dropped too, so it must take the slow path
+    if not has_escape and line.isascii() and '\x7f' not in line:
+        return line
+    if has_escape:
+        line = _ANSI_RE.sub('', line)
+    # Byte-level deletion table instead of a per-character filter
+    return line.encode('utf-8', 'ignore').translate(None, _NON_ASCII_BYTES).decode('ascii')
+
+def _handle_status(content, output_stream):
+    execution_state = content.get('execution_state', 'unknown')
+    if execution_state == 'busy':
+        log(f"🔄 Busy at {_hhmmss()}", output_stream)
+    elif execution_state == 'idle':
+        log(f"⚡ Idle at {_hhmmss()}", output_stream)
+
+# IOPub message type -> handler(content, output_stream)
+_HANDLERS = {
+    'stream': _handle_stream,
+    'execute_result': _handle_execute_result,
+    'display_data': _handle_display_data,
+    'error': _handle_error,
+    'status': _handle_status,
+}
+
+def output_hook(msg, output_stream=None, debug=False):
     """
     Hook to capture real-time output
     """
-    msg_type = msg['header']['msg_type']
-    content = msg.get('content', {})
-    
-    if msg_type == 'stream':
-        # Print, logging output
-        text = content.get('text', '')
-        log_raw(text, output_stream, end='')
-        
-    elif msg_type == 'execute_result':
-        # Expression result
-        data = content.get('data', {})
-        if 'text/plain' in data:
-            result = data['text/plain']
-            log(f"\n📤 Output: {result}", output_stream)
-            
-    elif msg_type == 'display_data':
-        # Plots, images
-        data = content.get('data', {})
-        if 'text/plain' in data:
-            display = data['text/plain']
-            log(f"\n🖼️ Display: {display}", output_stream)
-            
-    elif msg_type == 'error':
-        # Errors
-        ename = content.get('ename', 'Error')
-        evalue = content.get('evalue', 'Unknown error')
-        traceback = content.get('traceback', [])
-        
-        log(f"\n❌ {ename}: {evalue}", output_stream)
-        for line in traceback:
-            # Remove ANSI codes for cleaner output
-            clean_line = ''.join(char for char in line if ord(char) < 127)
-            log(clean_line, output_stream, level='ERROR')
-            
-    elif msg_type == 'status':
-        # Status updates
-        execution_state = content.get('execution_state', 'unknown')
-        if execution_state == 'busy':
-            log(f"🔄 Busy at {time.strftime('%H:%M:%S')}", output_stream)
-        elif execution_state == 'idle':
-            log(f"⚡ Idle at {time.strftime('%H:%M:%S')}", output_stream)
+    # A single dict lookup dispatches the message; the status check below is
+    # an identity comparison on the handler rather than a string compare
+    handler = _HANDLERS.get(msg['header']['msg_type'])
+    if handler is None:
+        return
+    # Status messages are the most frequent ones: only log them in debug mode
+    if handler is _handle_status and not debug:
+        return
+    handler(msg.get('content', {}), output_stream)
+
+def _hhmmss():
+    """Return the current time as HH:MM:SS, formatted at most once per second"""
+    t = int(time.time())
+    c = _ts_cache
+    if t != c[0]:
+        c[0] = t
+        c[1] = time.strftime('%H:%M:%S', time.localtime(t))
+    return c[1]
 
 def log(message, output_stream=None, level='INFO', end='\n'):
     """Unified logging for console and file (no timestamp)"""
-    formatted_msg = f"{message}"
-    
+    # Keep ordering: pending kernel stream output goes first
+    if _stream_buf.tell():
+        flush_stream_buffer(output_stream)
+
     # Write to console only if there is no output_stream
     if output_stream is None:
-        print(formatted_msg, end=end)
-    
+        print(message, end=end)
+
     # Write to file if specified
     if output_stream and not output_stream.closed:
-        output_stream.write(formatted_msg + end)
-        output_stream.flush()
+        output_stream.write(message)
+        if end:
+            output_stream.write(end)
+        if end == '\n':
+            flush_output(output_stream)
 
 def log_raw(message, output_stream=None, end='\n'):
     """Log without timestamp for raw code output"""
-    # Write to console only if there is no output_stream
+    line_done = end == '\n' or message.endswith('\n')
+
+    # Write to console only if there is no output_stream: complete lines are
+    # flushed by the terminal line buffering, only partial lines need a flush
     if output_stream is None:
-        sys.stdout.write(message + end)
-        sys.stdout.flush()
-    
-    # Write to file if specified
+        sys.stdout.write(message)
+        if end:
+            sys.stdout.write(end)
+        if not line_done:
+            sys.stdout.flush()
+
+    # Write to file if specified, flushing only on line boundaries
     if output_stream and not output_stream.closed:
-        output_stream.write(message + end)
+        output_stream.write(message)
+        if end:
+            output_stream.write(end)
+        if line_done:
+            flush_output(output_stream)
+
+def buffer_stream(text, output_stream=None):
+    """Queue kernel stream text, writing it out once enough is pending"""
+    _stream_buf.write(text)
+    if (_stream_buf.tell() >= STREAM_BUFFER_SIZE
+            or time.monotonic() - _last_stream_flush[0] >= STREAM_FLUSH_INTERVAL):
+        flush_stream_buffer(output_stream)
+
+def flush_stream_buffer(output_stream=None):
+    """Write out any queued kernel stream text"""
+    if _stream_buf.tell():
+        text = _stream_buf.getvalue()
+        _stream_buf.seek(0)
+        _stream_buf.truncate()
+        log_raw(text, output_stream, end='')
+    _last_stream_flush[0] = time.monotonic()
+
+def flush_output(output_stream, force=False):
+    """Flush the output file if forced or if FLUSH_INTERVAL has elapsed"""
+    if output_stream is None or output_stream.closed:
+        return
+    now = time.monotonic()
+    if force or now - _last_flush[0] > FLUSH_INTERVAL:
         output_stream.flush()
+        _last_flush[0] = now
+
+def _parse_json(data):
+    """Parse notebook JSON bytes, with orjson when it is installed"""
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # nbformat writes NaN/Infinity literals, which only json accepts
+            pass
+    return json.loads(data)
+
+def load_notebook(notebook_path, validate=True):
+    """
+    Load a notebook as nbformat v4 with a single read of the file.
+    Args:
+        notebook_path: Path to the notebook
+        validate: Validate against the nbformat schema (skip for read-only commands)
+    """
+    with open(notebook_path, "rb") as f:
+        nb = notebook_from_dict(_parse_json(f.read()))
+    if validate:
+        # Same policy as nbformat.reads: report schema errors, keep the notebook
+        try:
+            nbformat.validate(nb)
+        except nbformat.ValidationError as e:
+            log(f"⚠️ Notebook JSON is invalid: {e}")
+    return nb
+
+def notebook_from_dict(nb_dict):
+    """
+    Build a v4 NotebookNode from already parsed notebook JSON (no validation)
+    """
+    major, minor = nbformat.reader.get_version(nb_dict)
+    if major not in nbformat.versions:
+        raise nbformat.NBFormatError(f"Unsupported nbformat version {major}")
+    # Rejoins multi-line sources and drops transient fields, like nbformat.reads
+    nb = nbformat.versions[major].to_notebook_json(nb_dict, minor=minor)
+    if major != 4:
+        nb = nbformat.convert(nb, 4)
+    return nb
+
+def iter_code_cells(nb):
+    """Yield the code cells of a notebook in a single pass"""
+    for cell in nb.cells:
+        if cell.cell_type == 'code':
+            yield cell
+
+def code_cell_sources(nb):
+    """Stripped source of each non-empty code cell (the cells run executes), in one pass"""
+    return [code for code in (cell.source.strip() for cell in iter_code_cells(nb)) if code]
+
+def save_notebook(nb, notebook_path):
+    """
+    Atomically write a notebook: serialize once, write it with a single
+    call to a temporary file and rename it over the original
+    """
+    data = nbformat.writes(nb).encode("utf-8")
+    # Write through symlinks: replace the target, not the link itself
+    notebook_path = os.path.realpath(notebook_path)
+    tmp_path = notebook_path + ".tmp"
+    try:
+        with open(tmp_path, "wb", buffering=0) as f:
+            f.write(data)
+        # Keep the original permissions instead of the umask default
+        if os.path.exists(notebook_path):
+            shutil.copymode(notebook_path, tmp_path)
+        os.replace(tmp_path, notebook_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def edit_text(text, suffix=".py"):
+    """
+    Let the user edit text in $VISUAL / $EDITOR (default: nano) and return the result
+    """
+    import shlex
+    import subprocess
+    import tempfile
+
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+        editor = os.environ.get("VISUAL") or os.environ.get("EDITOR") or "nano"
+        # EDITOR may carry arguments, e.g. "code --wait"
+        subprocess.call(shlex.split(editor) + [path])
+        # Re-open by name: editors often save by replacing the file
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+    finally:
+        os.remove(path)
+
+def get_cache_dir(notebook_path):
+    """Directory holding the execution cache of a notebook"""
+    notebook_path = os.path.abspath(notebook_path)
+    return os.path.join(os.path.dirname(notebook_path), CACHE_DIR, os.path.basename(notebook_path))
+
+def chain_hash(prev_hash, code):
+    """Hash of a cell source chained with the hash of all previous cells"""
+    cell_hash = hashlib.blake2b(code.encode('utf-8'), digest_size=16).hexdigest()
+    return hashlib.blake2b((prev_hash + cell_hash).encode('ascii'), digest_size=16).hexdigest()
+
+def load_cached_outputs(cache_dir, key):
+    """Return the cached output messages for key, or None on a cache miss"""
+    try:
+        with open(os.path.join(cache_dir, key + '.json'), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def store_cached_outputs(cache_dir, key, outputs):
+    """Atomically store the output messages of a successful cell"""
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        path = os.path.join(cache_dir, key + '.json')
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(outputs, f)
+        os.replace(path + '.tmp', path)
+    except (OSError, TypeError, ValueError):
+        pass
+
+def clear_cache(notebook_path):
+    """Remove the execution cache of a notebook"""
+    shutil.rmtree(get_cache_dir(notebook_path), ignore_errors=True)
 
 def parse_cell_range(cell_range_str, total_cells):
     """
@@ -258,7 +874,7 @@ Examples:
   python run_notebook.py edit --cells 2-3 notebook.ipynb
   python run_notebook.py info notebook.ipynb
 
-This version uses execute_interactive() for more reliable execution.
+This version reads kernel output directly from the IOPub channel.
         """,
         add_help=False
     )
@@ -276,6 +892,37 @@ This version uses execute_interactive() for more reliable execution.
                             help="Debug mode with more output")
     parser_run.add_argument("--cells", "-c", type=str, default=None,
                             help="Range of code cells to execute, e.g. 2-5 or 3 (default: all)")
+    parser_run.add_argument("--cache", action="store_true",
+                            help="Replay the cached output of cells unchanged since the last run instead of executing them")
+    parser_run.add_argument("--clear-cache", action="store_true",
+                            help="Delete the notebook's execution cache before running")
+    parser_run.add_argument("--on-error", choices=ON_ERROR_CHOICES, default=None,
+                            help="When a cell fails: ask, continue or stop (default: ask on a terminal, otherwise stop)")
+    parser_run.add_argument("--parallel", "-p", type=int, default=0, metavar="N",
+                            help=f"Run consecutive cells starting with {PARALLEL_MAGIC} concurrently on N worker kernels")
+    parser_run.add_argument("--kernel", "-k", nargs="?", const=DAEMON_CONNECTION_FILE, default=None,
+                            metavar="CONNECTION_FILE",
+                            help=f"Run on the kernel started by the daemon command instead of a new one "
+                                 f"(default connection file: {DAEMON_CONNECTION_FILE})")
+
+    # Daemon command
+    parser_daemon = subparsers.add_parser("daemon", help="Keep a kernel running for run --kernel")
+    parser_daemon.add_argument("--connection-file", type=str, default=DAEMON_CONNECTION_FILE,
+                               help=f"Where to write the kernel connection file (default: {DAEMON_CONNECTION_FILE})")
+    parser_daemon.add_argument("--preload", type=str, default=None,
+                               help="Code to run once at startup, e.g. 'import numpy, pandas'")
+
+    # Batch command
+    parser_batch = subparsers.add_parser("batch", help="Run several notebooks reusing one kernel")
+    parser_batch.add_argument("notebooks", nargs="+", help="Paths to .ipynb files, run in order")
+    parser_batch.add_argument("--timeout", "-t", type=int, default=0,
+                              help="Timeout per cell in seconds (default: 0=no timeout)")
+    parser_batch.add_argument("--debug", action="store_true",
+                              help="Debug mode with more output")
+    parser_batch.add_argument("--cache", action="store_true",
+                              help="Replay the cached output of cells unchanged since the last run instead of executing them")
+    parser_batch.add_argument("--on-error", choices=ON_ERROR_CHOICES, default=None,
+                              help="When a cell fails: ask, continue or stop (default: ask on a terminal, otherwise stop)")
 
     # Show command
     parser_show = subparsers.add_parser("show", help="Show code of a cell or all code cells")
@@ -301,6 +948,8 @@ This version uses execute_interactive() for more reliable execution.
             parser.print_help()
             print("\nSub-commands:")
             subparsers.choices['run'].print_help()
+            subparsers.choices['batch'].print_help()
+            subparsers.choices['daemon'].print_help()
             subparsers.choices['show'].print_help()
             subparsers.choices['edit'].print_help()
             subparsers.choices['info'].print_help()
@@ -311,9 +960,8 @@ This version uses execute_interactive() for more reliable execution.
         sys.exit(1)
 
     if args.command == "show":
-        with open(args.notebook, "r", encoding="utf-8") as f:
-            nb = nbformat.read(f, as_version=4)
-        code_cells = [cell for cell in nb.cells if cell.cell_type == 'code']
+        nb = load_notebook(args.notebook, validate=False)
+        code_cells = list(iter_code_cells(nb))
         total_code_cells = len(code_cells)
         cell_range = None
         if args.cells:
@@ -327,22 +975,26 @@ This version uses execute_interactive() for more reliable execution.
             for i in range(start-1, end):
                 print(f"\n--- Cell {i+1} ---\n")
                 print(code_cells[i].source)
-                print("-" * 40)
+                print(SHOW_SEP)
         else:
             for i, cell in enumerate(code_cells, 1):
                 print(f"\n--- Cell {i} ---\n")
                 print(cell.source)
-                print("-" * 40)
+                print(SHOW_SEP)
         sys.exit(0)
 
     elif args.command == "info":
         try:
             stat = os.stat(args.notebook)
             mtime = datetime.fromtimestamp(stat.st_mtime)
-            with open(args.notebook, "r", encoding="utf-8") as f:
-                nb = nbformat.read(f, as_version=4)
-            total_cells = len(nb.cells)
-            code_cells = len([cell for cell in nb.cells if cell.cell_type == 'code'])
+            # Only cell types are needed: parse the raw JSON and skip nbformat validation
+            with open(args.notebook, "rb") as f:
+                nb = _parse_json(f.read())
+            if nb.get('nbformat', 4) < 4:
+                nb = notebook_from_dict(nb)
+            cells = nb.get('cells', [])
+            total_cells = len(cells)
+            code_cells = sum(1 for cell in cells if cell.get('cell_type') == 'code')
             print(f"📄 Notebook: {args.notebook}")
             print(f"🕒 Last modified: {mtime}")
             print(f"🔢 Total cells: {total_cells}")
@@ -352,12 +1004,8 @@ This version uses execute_interactive() for more reliable execution.
         sys.exit(0)
 
     elif args.command == "edit":
-        import tempfile
-        import subprocess
-
-        with open(args.notebook, "r", encoding="utf-8") as f:
-            nb = nbformat.read(f, as_version=4)
-        code_cells = [cell for cell in nb.cells if cell.cell_type == 'code']
+        nb = load_notebook(args.notebook)
+        code_cells = list(iter_code_cells(nb))
         total_code_cells = len(code_cells)
         modified = False
 
@@ -368,13 +1016,7 @@ This version uses execute_interactive() for more reliable execution.
             sys.exit(1)
         old_code = code_cells[idx].source
         print(f"\n--- Editing Cell {idx+1} ---\n")
-        with tempfile.NamedTemporaryFile("w+", suffix=".py") as tf:
-            tf.write(old_code)
-            tf.flush()
-            editor = os.environ.get("EDITOR", "nano")
-            subprocess.call([editor, tf.name])
-            tf.seek(0)
-            new_code = tf.read()
+        new_code = edit_text(old_code)
         if new_code != old_code:
             code_cells[idx].source = new_code
             modified = True
@@ -382,41 +1024,68 @@ This version uses execute_interactive() for more reliable execution.
         else:
             print(f"No changes made to cell {idx+1}.")
         if modified:
-            with open(args.notebook, "w", encoding="utf-8") as f:
-                nbformat.write(nb, f)
+            save_notebook(nb, args.notebook)
         sys.exit(0)
 
     elif args.command == "run":
         output_file = args.output
         timeout = None if args.timeout == 0 else args.timeout
 
+        # Parsed and stripped at most once: reused by run_notebook_realtime_extended
+        sources = None
         cell_range = None
         if args.cells:
-            with open(args.notebook, "r", encoding="utf-8") as f:
-                nb = nbformat.read(f, as_version=4)
-            total_code_cells = len([cell for cell in nb.cells if cell.cell_type == 'code' and cell.source.strip()])
             try:
-                cell_range = parse_cell_range(args.cells, total_code_cells)
+                sources = code_cell_sources(load_notebook(args.notebook))
+            except FileNotFoundError:
+                print(f"❌ Error: Notebook file '{args.notebook}' not found")
+                sys.exit(1)
+            try:
+                cell_range = parse_cell_range(args.cells, len(sources))
             except Exception as e:
                 print(f"❌ {e}")
                 sys.exit(1)
 
+        if args.clear_cache:
+            clear_cache(args.notebook)
+
         start_msg = f"🚀 Starting notebook execution: {args.notebook}"
         timeout_msg = f"⏱️  Cell timeout: {'No limit' if timeout is None else f'{timeout}s'}"
         output_msg = f"📝 Output: {'Console only' if not output_file else f'Console + {output_file}'}"
         mode_msg = f"🔧 Mode: Interactive"
         cells_msg = f"🔢 Cells: {args.cells if args.cells else 'all'}"
+        cache_msg = f"💾 Cache: {get_cache_dir(args.notebook) if args.cache else 'disabled'}"
+        kernel_msg = f"🔌 Kernel: {args.kernel if args.kernel else 'new'}"
+        parallel_msg = f"🔀 Parallel: {f'{args.parallel} worker kernels' if args.parallel > 1 else 'off'}"
+        on_error = args.on_error or default_on_error()
+        on_error_msg = f"⚠️  On error: {on_error}"
 
         print(start_msg)
         print(timeout_msg)
         print(output_msg)
         print(mode_msg)
         print(cells_msg)
+        print(cache_msg)
+        print(kernel_msg)
+        print(parallel_msg)
+        print(on_error_msg)
         print("🔄 Use Ctrl+C to interrupt execution")
         print("📝 Each cell waits for the previous one to complete\n")
 
+        kernel = None
+        if args.kernel:
+            try:
+                kernel = connect_kernel(args.kernel)
+            except Exception as e:
+                print(f"❌ Cannot connect to kernel '{args.kernel}': {e}")
+                print("   Start one with: python notebook_toolkit.py daemon")
+                sys.exit(1)
+
         try:
-            run_notebook_realtime_extended(args.notebook, timeout, output_file, cell_range)
+            completed, failed_cells = run_notebook_realtime_extended(
+                args.notebook, timeout, output_file, cell_range, args.debug,
+                use_cache=args.cache, kernel=kernel, sources=sources,
+                parallel=args.parallel, on_error=on_error)
         except FileNotFoundError:
             msg = f"❌ Error: Notebook file '{args.notebook}' not found"
             if output_file:
@@ -434,8 +1103,17 @@ This version uses execute_interactive() for more reliable execution.
                 import traceback
                 traceback.print_exc()
             sys.exit(1)
+        finally:
+            if kernel is not None:
+                stop_kernel(*kernel)
 
-        final_msg = "🎉 Notebook execution completed!"
+        if failed_cells:
+            final_msg = f"❌ Notebook execution finished with {len(failed_cells)} failed cell(s): " \
+                        f"{', '.join(map(str, failed_cells))}"
+        elif not completed:
+            final_msg = "🛑 Notebook execution stopped before the last cell"
+        else:
+            final_msg = "🎉 Notebook execution completed!"
         print(f"\n{final_msg}")
         if output_file:
             try:
@@ -443,6 +1121,95 @@ This version uses execute_interactive() for more reliable execution.
                     f.write(f"{final_msg}\n")
             except:
                 pass
+        if failed_cells or not completed:
+            sys.exit(1)
+
+    elif args.command == "batch":
+        timeout = None if args.timeout == 0 else args.timeout
+        print(f"🚀 Starting batch execution of {len(args.notebooks)} notebooks (one shared kernel)")
+        print("🔄 Use Ctrl+C to interrupt execution\n")
+
+        on_error = args.on_error or default_on_error()
+        failed = []
+        stopped = False
+        try:
+            kernel = start_kernel()
+        except Exception as e:
+            print(f"❌ Unexpected error: {e}")
+            sys.exit(1)
+        try:
+            for path in args.notebooks:
+                print(f"\n📓 Notebook: {path}")
+                try:
+                    completed, failed_cells = run_notebook_realtime_extended(
+                        path, timeout, None, None, args.debug,
+                        use_cache=args.cache, kernel=kernel, on_error=on_error)
+                except FileNotFoundError:
+                    print(f"❌ Error: Notebook file '{path}' not found")
+                    failed.append(path)
+                    continue
+                except Exception as e:
+                    print(f"❌ Unexpected error: {e}")
+                    if args.debug:
+                        import traceback
+                        traceback.print_exc()
+                    failed.append(path)
+                    continue
+                if failed_cells:
+                    failed.append(path)
+                # --on-error stop only ends the failing notebook; a user stop
+                # (prompt answer or Ctrl+C) ends the whole batch
+                if not completed and not (failed_cells and on_error == 'stop'):
+                    stopped = True
+                    print("🛑 Batch stopped")
+                    break
+        finally:
+            print("\n📋 Cleaning up...")
+            stop_kernel(*kernel)
+
+        if failed:
+            print(f"\n❌ {len(failed)} notebook(s) failed: {', '.join(failed)}")
+        if stopped:
+            print("🛑 Batch stopped before the last notebook")
+        if failed or stopped:
+            sys.exit(1)
+        print("\n🎉 Batch execution completed!")
+
+    elif args.command == "daemon":
+        print("🚀 Starting kernel daemon")
+        try:
+            km, kc = start_kernel(connection_file=args.connection_file)
+        except Exception as e:
+            print(f"❌ Unexpected error: {e}")
+            sys.exit(1)
+        # Shut the kernel down on SIGTERM too, not only on Ctrl+C
+        import signal
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            if args.preload:
+                print(f"📦 Preloading: {args.preload}")
+                reply = execute_and_drain(kc, args.preload, None, output_hook, on_wait=flush_stream_buffer)
+                flush_stream_buffer()
+                if reply['content']['status'] == 'error':
+                    print("⚠️ Preload failed")
+            # The daemon only watches the kernel: drop its channels so output
+            # of the clients' runs does not pile up here
+            kc.stop_channels()
+            print(f"🔌 Kernel running, connection file: {km.connection_file}")
+            print("   Use it with: python notebook_toolkit.py run notebook.ipynb --kernel")
+            print("🔄 Use Ctrl+C to stop the daemon")
+            while km.is_alive():
+                time.sleep(1)
+            print("❌ Kernel died")
+        except KeyboardInterrupt:
+            pass
+        finally:
+            print("\n📋 Shutting down kernel...")
+            try:
+                km.shutdown_kernel()
+            except:
+                pass
+            print("✅ Cleanup complete")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file